@@ -1,5 +1,5 @@
 import sqlite3
-from src.data.edhrec_scraper import EDHRECScraper, setup_database, empty_tables
+from src.data.edhrec_scraper import EDHRECScraper, setup_database, finalize_indexes, empty_tables
 import argparse
 
 # currently can only hit top 100 commanders, need to figure out how to trigger the 'load more' button on the top commanders page
@@ -11,6 +11,11 @@ def main():
     args = parser.parse_args()
     
     conn = sqlite3.connect('data/raw/edhrec_decks.db')
+    # WAL + relaxed sync so commits don't each force an fsync of the main db file
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA cache_size=-262144")  # 256 MiB
     scraper = EDHRECScraper(conn)
 
     if not args.continue_existing_db:
@@ -26,6 +31,7 @@ def main():
     )
     
     conn.commit()
+    finalize_indexes(conn)
     conn.close()
 
 if __name__ == "__main__":
@@ -1,14 +1,33 @@
+import json
+from pathlib import Path
+import numpy as np
 import torch
 
 class EDHRECDataLoader:
     def __init__(self):
         pass
 
+def train_valid_indices(n, valid_ratio=0.1):
+    """Shuffled training and validation indices for n examples, e.g. for a SubsetRandomSampler over shared data"""
+    perm = torch.randperm(n)
+    split_idx = int(n * (1 - valid_ratio))
+    return perm[:split_idx], perm[split_idx:]
+
 def train_valid_split(data, valid_ratio=0.1):
     """Splits data into training and validation sets"""
-    n = len(data)
-    data_shuffled = data[torch.randperm(n)]
-    split_idx = int(n * (1 - valid_ratio))
-    train_data = data_shuffled[:split_idx]
-    valid_data = data_shuffled[split_idx:]
-    return train_data, valid_data
+    # Gather each split directly instead of materializing a full shuffled copy first
+    train_idx, valid_idx = train_valid_indices(len(data), valid_ratio)
+    return data[train_idx], data[valid_idx]
+
+def load_training_set(path='data/processed/training_set'):
+    """Memory-map a training set written by TrainingSetCreator as (data, scores) tensors, without copying"""
+    path = Path(path)
+    with open(path / "meta.json") as f:
+        num_examples = json.load(f)['num_examples']
+    # np.memmap can't map an empty file
+    if num_examples == 0:
+        return torch.empty((0, 3), dtype=torch.int32), torch.empty(0, dtype=torch.bfloat16)
+    # Copy-on-write maps give torch writable arrays while the files on disk stay untouched
+    data = np.memmap(path / "data.dat", dtype=np.int32, mode='c', shape=(num_examples, 3))
+    scores = np.memmap(path / "scores.dat", dtype=np.int16, mode='c', shape=(num_examples,))
+    return torch.from_numpy(data), torch.from_numpy(scores).view(torch.bfloat16)
@@ -1,20 +1,51 @@
-import requests
+import asyncio
+import httpx
 from bs4 import BeautifulSoup
-import time
+import lxml.html
+import json
 import re
-import sqlite3
 from collections import Counter
 
+_SLUG_SPACE_RE = re.compile(r'[,\s]+')
+_SLUG_PUNCT_RE = re.compile(r'[^\w\-]')
+_SLUG_DASH_RE = re.compile(r'-+')
+_CARD_NAME_CLASS_RE = re.compile(r'Card.*name')
+_HASH_RE = re.compile(r'"urlhash"\s*:\s*"([^"]+)"')
+
+# Fallback for deck pages where the decklist isn't in the __NEXT_DATA__ blob
+_CARDS_RE = re.compile(r'"deck_preview":\{.*?"cards":\[(.*?)\]', re.DOTALL)
+_CARD_NAME_RE = re.compile(r'"([^"]+)"')
+
+def _find_json_key(obj, key):
+    """Depth-first search of parsed JSON for the first value stored under key"""
+    stack = [obj]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, dict):
+            if key in node:
+                return node[key]
+            stack.extend(node.values())
+        elif isinstance(node, list):
+            stack.extend(node)
+    return None
+
 class EDHRECScraper:
-    def __init__(self, db_connection):
+    def __init__(self, db_connection, max_concurrency=16, max_connections=32, max_retries=3, retry_backoff=1.0):
         self.base_url = "https://edhrec.com"
         self.headers = {
             'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36'
         }
-        self.session = requests.Session()
-        self.session.headers.update(self.headers)
+        self.max_concurrency = max_concurrency
+        self.max_connections = max_connections
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
         self.db_connection = db_connection
         self.db_cursor = db_connection.cursor()
+        self._commander_ids = {}
+        self._card_ids = None
+        self._next_card_id = None
+        self._throttle_lock = None
+        self._next_request_time = 0.0
         
     def _create_slug(self, name):
         """Convert commander name to URL slug"""
@@ -23,25 +54,44 @@ class EDHRECScraper:
         # Remove apostrophes and quotes
         slug = slug.replace("'", "").replace('"', "")
         # Replace spaces and commas with hyphens
-        slug = re.sub(r'[,\s]+', '-', slug)
+        slug = _SLUG_SPACE_RE.sub('-', slug)
         # Remove other special characters
-        slug = re.sub(r'[^\w\-]', '', slug)
+        slug = _SLUG_PUNCT_RE.sub('', slug)
         # Clean up multiple hyphens
-        slug = re.sub(r'-+', '-', slug.strip('-'))
+        slug = _SLUG_DASH_RE.sub('-', slug.strip('-'))
         # Handle special cases
         if "//" in name:  # For partner commanders
             slug = slug.replace("//-", "-")
         return slug
     
-    def _get_commanders_from_page(self):
+    async def _throttle(self, delay):
+        """Space out request start times by at least `delay` seconds across all tasks"""
+        async with self._throttle_lock:
+            loop = asyncio.get_running_loop()
+            wait = self._next_request_time - loop.time()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            self._next_request_time = loop.time() + delay
+
+    async def _fetch(self, client, url, timeout):
+        """GET a page, retrying with exponential backoff on 429 and 5xx responses"""
+        for attempt in range(self.max_retries + 1):
+            response = await client.get(url, timeout=timeout)
+            if (response.status_code != 429 and response.status_code < 500) or attempt == self.max_retries:
+                return response
+            await asyncio.sleep(self.retry_backoff * 2 ** attempt)
+
+    async def _get_commanders_from_page(self, client):
         """Scrape commander names from the EDHREC commanders page"""
         url = f"{self.base_url}/commanders"
         print(f"Fetching commanders from: {url}")
         
         try:
-            response = self.session.get(url, timeout=30)
+            response = await self._fetch(client, url, timeout=30)
             response.raise_for_status()
-            soup = BeautifulSoup(response.content, 'html.parser')
+            # lxml is much faster than html.parser, and passing the already decoded text
+            # skips BeautifulSoup's own character set detection
+            soup = BeautifulSoup(response.text, 'lxml')
             
             commanders = []
             
@@ -50,7 +100,7 @@ class EDHRECScraper:
             
             if not name_elements:
                 # Try alternative patterns
-                name_elements = soup.find_all('span', class_=re.compile(r'Card.*name'))
+                name_elements = soup.find_all('span', class_=_CARD_NAME_CLASS_RE)
             
             for elem in name_elements:
                 name = elem.text.strip()
@@ -64,7 +114,7 @@ class EDHRECScraper:
             print(f"Error fetching commanders: {e}")
             return []
     
-    def _get_deck_hashes_from_commander_page(self, commander_name):
+    async def _get_deck_hashes_from_commander_page(self, client, commander_name):
         """Extract only deck URL hashes from a commander's page"""
         slug = self._create_slug(commander_name)
         url = f"{self.base_url}/decks/{slug}"
@@ -74,16 +124,14 @@ class EDHRECScraper:
         deck_hashes = []
 
         try:
-            response = self.session.get(url, timeout=10)
+            response = await self._fetch(client, url, timeout=10)
 
             if response.status_code != 200:
                 print(f"  ✗ Error {response.status_code} accessing commander page")
                 return deck_hashes
 
             # Search for all occurrences of "urlhash":"HASH_VALUE"
-            page_text = response.text
-            pattern = r'"urlhash"\s*:\s*"([^"]+)"'
-            deck_hashes = re.findall(pattern, page_text)
+            deck_hashes = _HASH_RE.findall(response.text)
 
             if deck_hashes:
                 print(f"  ✓ Found {len(deck_hashes)} deck hashes")
@@ -95,20 +143,34 @@ class EDHRECScraper:
 
         return deck_hashes
 
-    def _extract_decklist(self, deck_url_hash):
+    def _parse_decklist(self, content):
+        """Get the card names from a deck page, returns None if no decklist is found"""
+        # The deck is embedded as JSON in the Next.js data script, parse that directly
+        try:
+            next_data = lxml.html.fromstring(content).get_element_by_id("__NEXT_DATA__").text
+            deck_preview = _find_json_key(json.loads(next_data), "deck_preview")
+            cards = deck_preview["cards"]
+            if isinstance(cards, list) and all(isinstance(card, str) for card in cards):
+                return cards
+        except (KeyError, TypeError, ValueError, lxml.etree.LxmlError):
+            pass
+
+        match = _CARDS_RE.search(content.decode('utf-8', errors='replace'))
+        return _CARD_NAME_RE.findall(match.group(1)) if match else None
+
+    async def _extract_decklist(self, client, deck_url_hash):
         """Visit an individual deck page"""
         deck_url = f"{self.base_url}/deckpreview/{deck_url_hash}"
         
         try:
-            response = self.session.get(deck_url, timeout=10)
+            response = await self._fetch(client, deck_url, timeout=10)
             if response.status_code == 200:
                 print(f"    ✓ Deck: {deck_url_hash}")
-                decklist = re.search(r'"deck_preview":\{.*?"cards":\[(.*?)\].*?\}', response.text, re.DOTALL)
-                print(f"      Cards: {decklist.group(1)[:60]}..." if decklist else "      No cards found")
-                if decklist:
-                    cards = re.findall(r'"([^"]+)"', decklist.group(1))
+                cards = self._parse_decklist(response.content)
+                print(f"      Cards: {', '.join(cards)[:60]}..." if cards is not None else "      No cards found")
+                if cards is not None:
                     print(f"      Total cards: {len(cards)}")
-                return cards if decklist else False
+                return cards if cards is not None else False
             else:
                 print(f"    ✗ Error {response.status_code}: {deck_url_hash}")
                 return False
@@ -116,14 +178,31 @@ class EDHRECScraper:
             print(f"    ✗ Failed: {deck_url_hash} - {str(e)[:30]}")
             return False
 
+    def _get_commander_id(self, commander_name):
+        """Get a commander's id, inserting the commander if it doesn't exist yet"""
+        # Memoized since every deck of a commander is saved with the same name. Not an upsert with
+        # RETURNING, since conflicts would burn AUTOINCREMENT ids and checkpointing relies on
+        # commander ids matching their position in the commanders list
+        if commander_name not in self._commander_ids:
+            c = self.db_cursor
+            row = c.execute("SELECT id FROM commanders WHERE name = ?", (commander_name,)).fetchone()
+            if row is None:
+                row = (c.execute("INSERT INTO commanders (name) VALUES (?)", (commander_name,)).lastrowid,)
+            self._commander_ids[commander_name] = row[0]
+        return self._commander_ids[commander_name]
+
+    def _load_card_ids(self):
+        """Cache every card's id by name, cards.name has no index until scraping finishes"""
+        c = self.db_cursor
+        self._card_ids = dict(c.execute("SELECT name, id FROM cards"))
+        row = c.execute("SELECT seq FROM sqlite_sequence WHERE name = 'cards'").fetchone()
+        self._next_card_id = (row[0] if row else 0) + 1
+
     def _save_decklist(self, commander_name, deck_url_hash, decklist):
         """Save the commander, deck, and cards to the database"""
         c = self.db_cursor
         
-        # Insert commander if not exists
-        if c.execute("SELECT id FROM commanders WHERE name = ?", (commander_name,)).fetchone() is None:
-            c.execute("INSERT OR IGNORE INTO commanders (name) VALUES (?)", (commander_name,))
-        commander_id = c.execute("SELECT id FROM commanders WHERE name = ?", (commander_name,)).fetchone()[0]
+        commander_id = self._get_commander_id(commander_name)
 
         # Insert deck
         c.execute("INSERT INTO decks (commander_id, url_hash) VALUES (?, ?)", (commander_id, deck_url_hash))
@@ -134,24 +213,27 @@ class EDHRECScraper:
             print(f"      ✗ Skipping deck with {len(decklist)} cards (over 99 limit)")
             return
         
-        counter = Counter(decklist)
-        duplicates = [card for card, count in counter.items() if count > 1]
-        if duplicates:
+        # Only build the histogram when there is a duplicate to report
+        if len(set(decklist)) != len(decklist):
+            duplicates = [card for card, count in Counter(decklist).items() if count > 1]
             print(f"      ✗ Skipping deck with duplicate cards: {', '.join(duplicates)}")
             return
         
-        for card_name in decklist:
-            if c.execute("SELECT id FROM cards WHERE name = ?", (card_name,)).fetchone() is None:
-                c.execute("INSERT OR IGNORE INTO cards (name) VALUES (?)", (card_name,))
-            card_id = c.execute("SELECT id FROM cards WHERE name = ?", (card_name,)).fetchone()[0]
-            
-            try:
-                c.execute("INSERT INTO deck_cards (deck_id, card_id) VALUES (?, ?)", (deck_id, card_id))
-            except sqlite3.IntegrityError:
-                print(f"      ✗ Duplicate card entry for deck {deck_id} and card {card_id}")
-                print(f" deck_hash: {deck_url_hash}, card_name: {card_name}")
+        # Dedupe cards against the in-memory name -> id cache and batch insert only the new ones,
+        # assigning their ids here so they never need to be looked up by name
+        if self._card_ids is None:
+            self._load_card_ids()
+        new_cards = [card_name for card_name in decklist if card_name not in self._card_ids]
+        if new_cards:
+            new_ids = range(self._next_card_id, self._next_card_id + len(new_cards))
+            c.executemany("INSERT INTO cards (id, name) VALUES (?, ?)", zip(new_ids, new_cards))
+            self._card_ids.update(zip(new_cards, new_ids))
+            self._next_card_id += len(new_cards)
 
-        self.db_connection.commit()
+        c.executemany(
+            "INSERT OR IGNORE INTO deck_cards (deck_id, card_id) VALUES (?, ?)",
+            [(deck_id, self._card_ids[card_name]) for card_name in decklist]
+        )
 
     def _get_last_commander_id(self):
             c = self.db_cursor
@@ -168,62 +250,79 @@ class EDHRECScraper:
         self.db_connection.commit()
         print(f"  Removed existing decks for commander ID {commander_id}")
 
+    async def _visit_deck(self, client, semaphore, commander, deck_url_hash, deck_delay):
+        """Fetch one deck page and save its decklist, returns whether the visit succeeded"""
+        async with semaphore:
+            await self._throttle(deck_delay)
+            decklist = await self._extract_decklist(client, deck_url_hash)
+        if not decklist:
+            return False
+        # SAVE TO DATABASE
+        self._save_decklist(commander, deck_url_hash, decklist)
+        return True
+
     def gather_decks(self, num_commanders, decks_per_commander, deck_delay=0.5, commander_delay=2, checkpoint=False):
         """Main function to visit all commander pages and their decks"""
-        commanders = self._get_commanders_from_page()
-        
-        if not commanders:
-            print("No commanders found!")
-            return
-        
-        if checkpoint:
-            # restart from last commander with saved decks after resetting all decks from that commander
-            last_commander_id = self._get_last_commander_id()
-            self._remove_decks_by_commander_id(last_commander_id)
-            checkpoint_idx = last_commander_id - 1  # Convert to 0-based index
-
-            print(f"Resuming from commander id: {last_commander_id}, commander name: '{commanders[checkpoint_idx]}'")
-        else:
-            checkpoint_idx = 0
-        
-        # Limit to specified number of commanders
-        commanders = commanders[checkpoint_idx:num_commanders]
-        
-        total_decks_visited = 0
-        successful_visits = 0
-        failed_visits = 0
-        
-        for i, commander in enumerate(commanders, 1):
-            print(f"\n[{i}/{len(commanders)}] Processing: {commander}")
-            print("=" * 60)
+        asyncio.run(self._gather_decks(num_commanders, decks_per_commander, deck_delay, commander_delay, checkpoint))
+
+    async def _gather_decks(self, num_commanders, decks_per_commander, deck_delay, commander_delay, checkpoint):
+        self._throttle_lock = asyncio.Lock()
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        # HTTP/2 multiplexes concurrent requests over pooled connections, so TLS handshakes are paid once
+        limits = httpx.Limits(max_connections=self.max_connections, max_keepalive_connections=self.max_connections)
+
+        async with httpx.AsyncClient(http2=True, limits=limits, timeout=10.0, headers=self.headers) as client:
+            commanders = await self._get_commanders_from_page(client)
             
-            # Get deck hashes from commander page
-            deck_hashes = self._get_deck_hashes_from_commander_page(commander)
+            if not commanders:
+                print("No commanders found!")
+                return
             
-            if deck_hashes:
-                print(f"  Visiting {len(deck_hashes)} deck pages...")
-                # Visit each deck page (limit to specified number for each commander to be respectful)
-                decks_to_visit = deck_hashes[:decks_per_commander]
-                for j, deck_url_hash in enumerate(decks_to_visit, 1):
-                    print(f"  [{j}/{len(decks_to_visit)}]", end=" ")
-                    if decklist := self._extract_decklist(deck_url_hash):
-                        successful_visits += 1
-                        # SAVE TO DATABASE
-                        self._save_decklist(commander, deck_url_hash, decklist)
-                    else:
-                        failed_visits += 1
-                    
-                    total_decks_visited += 1
-                    
-                    # Delay between deck requests
-                    if j < len(decks_to_visit):
-                        time.sleep(deck_delay)
+            if checkpoint:
+                # restart from last commander with saved decks after resetting all decks from that commander
+                last_commander_id = self._get_last_commander_id()
+                self._remove_decks_by_commander_id(last_commander_id)
+                checkpoint_idx = last_commander_id - 1  # Convert to 0-based index
+
+                print(f"Resuming from commander id: {last_commander_id}, commander name: '{commanders[checkpoint_idx]}'")
             else:
-                print(f"  No decks found for {commander}")
+                checkpoint_idx = 0
+            
+            # Limit to specified number of commanders
+            commanders = commanders[checkpoint_idx:num_commanders]
             
-            # Delay between commanders
-            if i < len(commanders):
-                time.sleep(commander_delay)
+            total_decks_visited = 0
+            successful_visits = 0
+            failed_visits = 0
+            
+            for i, commander in enumerate(commanders, 1):
+                print(f"\n[{i}/{len(commanders)}] Processing: {commander}")
+                print("=" * 60)
+                
+                # Get deck hashes from commander page
+                deck_hashes = await self._get_deck_hashes_from_commander_page(client, commander)
+                
+                if deck_hashes:
+                    print(f"  Visiting {len(deck_hashes)} deck pages...")
+                    # Visit deck pages concurrently (limit to specified number for each commander to be respectful),
+                    # request starts are still spaced out by deck_delay
+                    decks_to_visit = deck_hashes[:decks_per_commander]
+                    results = await asyncio.gather(*[
+                        self._visit_deck(client, semaphore, commander, deck_url_hash, deck_delay)
+                        for deck_url_hash in decks_to_visit
+                    ])
+                    successful_visits += sum(results)
+                    failed_visits += len(results) - sum(results)
+                    total_decks_visited += len(results)
+
+                    # Commit all decks for this commander in one transaction
+                    self.db_connection.commit()
+                else:
+                    print(f"  No decks found for {commander}")
+                
+                # Delay between commanders
+                if i < len(commanders):
+                    await asyncio.sleep(commander_delay)
         
         # Print summary
         print("\n" + "=" * 60)
@@ -238,14 +337,16 @@ class EDHRECScraper:
             print(f"Success rate: {success_rate:.1f}%")
 
 def setup_database(conn):
+    """Create the tables, indexes other than primary keys are left to finalize_indexes"""
     c = conn.cursor()
     # Create tables if they don't exist
     c.execute('''CREATE TABLE IF NOT EXISTS commanders(
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
                 name TEXT NOT NULL UNIQUE)''')
+    # cards.name uniqueness is enforced by the scraper while loading, and by an index afterwards
     c.execute('''CREATE TABLE IF NOT EXISTS cards(
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
-                name TEXT NOT NULL UNIQUE)''')
+                name TEXT NOT NULL)''')
     c.execute('''CREATE TABLE IF NOT EXISTS decks(
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
                 commander_id INTEGER REFERENCES commanders(id),
@@ -256,11 +357,22 @@ def setup_database(conn):
                 PRIMARY KEY (deck_id, card_id))''')
     conn.commit()
 
+def finalize_indexes(conn):
+    """Create indexes once bulk scraping is done, so inserts don't maintain them row by row"""
+    c = conn.cursor()
+    c.execute('''CREATE UNIQUE INDEX IF NOT EXISTS idx_cards_name ON cards(name)''')
+    # Covering index for lookups by card; the primary key already covers lookups by deck
+    c.execute('''CREATE INDEX IF NOT EXISTS idx_deck_cards_card ON deck_cards(card_id, deck_id)''')
+    c.execute('''CREATE INDEX IF NOT EXISTS idx_decks_commander ON decks(commander_id)''')
+    conn.commit()
+    # Refresh planner statistics so the training set queries use the indexes
+    c.execute("ANALYZE")
+
 def empty_tables(conn):
+    """Drop and recreate every table for a fresh scrape, so indexes and constraints from older schemas don't survive"""
     c = conn.cursor()
-    c.execute("DELETE FROM deck_cards")
-    c.execute("DELETE FROM decks")
-    c.execute("DELETE FROM cards")
-    c.execute("DELETE FROM commanders")
-    c.execute("DELETE FROM sqlite_sequence")
+    # Dropping also removes the tables' indexes and sqlite_sequence rows
+    for table in ('deck_cards', 'decks', 'cards', 'commanders'):
+        c.execute(f"DROP TABLE IF EXISTS {table}")
     conn.commit()
+    setup_database(conn)
@@ -1,11 +1,38 @@
 import sqlite3
+import hashlib
+import json
+import os
+from pathlib import Path
+from itertools import chain
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 import torch
 import time
-from math import log2
+from src.data.data_loader import load_training_set
+
+# Bits per card id in packed (commander, condition, target) keys
+CARD_ID_BITS = 20
+# Bump when the on-disk conditional rate cache format changes
+CONDITIONAL_RATES_CACHE_VERSION = 1
+
+def _conditional_rate_keys(commander_ids, condition_card_ids, target_card_ids):
+    """Pack (commander, condition, target) ids into int64 keys that sort in the same order as the tuples"""
+    return (
+        (np.asarray(commander_ids, dtype=np.int64) << (2 * CARD_ID_BITS))
+        | (np.asarray(condition_card_ids, dtype=np.int64) << CARD_ID_BITS)
+        | np.asarray(target_card_ids, dtype=np.int64)
+    )
 
 class TrainingSetCreator:
-    def __init__(self, db_path = 'edhrec_decks.db', inclusion_threshold=100):
+    def __init__(self, db_path = 'edhrec_decks.db', inclusion_threshold=100, cache_dir='data/processed'):
+        self.db_path = db_path
+        self.cache_dir = Path(cache_dir)
         self.conn = sqlite3.connect(db_path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("PRAGMA temp_store=MEMORY")
+        self.conn.execute("PRAGMA cache_size=-262144")  # 256 MiB
         self.cursor = self.conn.cursor()
         self.num_commanders = self.cursor.execute("SELECT COUNT(*) FROM commanders").fetchone()[0]
         self.num_decks = self.cursor.execute("SELECT COUNT(*) FROM decks").fetchone()[0]
@@ -15,210 +42,290 @@ class TrainingSetCreator:
         self.score_fn = self.pmi
         
         # cache to speed up repeated queries
+        self.deck_card_commanders = None  # commander id of each deck_cards row
+        self.deck_card_ids = None  # card id of each deck_cards row
+        self.card_deck_counts = None  # number of decks containing each card, indexed by card id
         self.cards_above_threshold_cache = {}
-        self.inclusion_rates_cache = {}
-        self.conditional_rates_cache = {}
+        self.inclusion_rates_cache = None
+        self.inclusion_rates_threshold = None
+        # conditional rates as packed keys and rates sorted by key, see _precompute_all_conditional_rates
+        self.conditional_rates_cache = None
         
-        # Pre-compute inclusion rates for cards above the threshold with one query
+        # Pre-compute inclusion rates for cards above the threshold
         self._precompute_inclusion_rates(inclusion_threshold)
 
+    def _load_deck_cards(self):
+        """Materialize deck_cards joined with decks as NumPy arrays, one scan of each table"""
+        if self.deck_card_ids is not None:
+            return
+        
+        decks = np.fromiter(
+            chain.from_iterable(self.cursor.execute("SELECT id, commander_id FROM decks")), dtype=np.int32
+        ).reshape(-1, 2)
+        deck_cards = np.fromiter(
+            chain.from_iterable(self.cursor.execute("SELECT deck_id, card_id FROM deck_cards")), dtype=np.int32
+        ).reshape(-1, 2)
+        
+        # Dense deck id -> commander id lookup to do the join
+        deck_commanders = np.zeros(decks[:, 0].max(initial=0) + 1, dtype=np.int32)
+        deck_commanders[decks[:, 0]] = decks[:, 1]
+        
+        self.deck_card_commanders = deck_commanders[deck_cards[:, 0]]
+        self.deck_card_ids = deck_cards[:, 1]
+        # (deck_id, card_id) is the primary key, so row counts are distinct deck counts
+        self.card_deck_counts = np.bincount(self.deck_card_ids)
+
     def _get_cards_above_threshold(self, threshold):
+        """Sorted array of ids of cards included in more than threshold decks"""
         if threshold not in self.cards_above_threshold_cache:
-            result = self.cursor.execute("""
-                SELECT card_id
-                FROM deck_cards
-                GROUP BY card_id
-                HAVING COUNT(DISTINCT deck_id) > ?
-            """, (threshold,)).fetchall()
-            self.cards_above_threshold_cache[threshold] = set(row[0] for row in result)
+            self._load_deck_cards()
+            self.cards_above_threshold_cache[threshold] = np.flatnonzero(self.card_deck_counts > threshold)
 
         return self.cards_above_threshold_cache[threshold]
 
     def _get_commander_card_pairs_above_threshold(self, threshold):
-        cards_list = list(self._get_cards_above_threshold(threshold))
-
-        # Use IN clause with cached card IDs
-        placeholders = ','.join('?' * len(cards_list))
-        result = self.cursor.execute(f"""
-            SELECT DISTINCT d.commander_id, dc.card_id
-            FROM decks d
-            INNER JOIN deck_cards dc ON d.id = dc.deck_id
-            WHERE dc.card_id IN ({placeholders})
-            ORDER BY d.commander_id, dc.card_id
-        """, cards_list).fetchall()
+        """Distinct (commander_id, card_id) pairs for cards above threshold, as two arrays sorted by commander then card"""
+        self._load_deck_cards()
+        above_threshold = (self.card_deck_counts > threshold)[self.deck_card_ids]
         
-        return result
-
-    def _get_all_commander_cards_above_threshold(self, threshold):
-        """Get all commander->cards mappings in one query"""
-        cards_list = list(self._get_cards_above_threshold(threshold))
-
-        placeholders = ','.join('?' * len(cards_list))
-        result = self.cursor.execute(f"""
-            SELECT DISTINCT d.commander_id, dc.card_id
-            FROM decks d
-            INNER JOIN deck_cards dc ON d.id = dc.deck_id
-            WHERE dc.card_id IN ({placeholders})
-            ORDER BY d.commander_id, dc.card_id
-        """, cards_list).fetchall()
-        
-        # Group by commander
-        commander_cards = {}
-        for commander_id, card_id in result:
-            if commander_id not in commander_cards:
-                commander_cards[commander_id] = []
-            commander_cards[commander_id].append(card_id)
-        
-        return commander_cards
+        # Encode each pair as a single integer so np.unique dedupes and sorts them in one pass
+        num_card_ids = len(self.card_deck_counts)
+        pair_keys = np.unique(
+            self.deck_card_commanders[above_threshold].astype(np.int64) * num_card_ids + self.deck_card_ids[above_threshold]
+        )
+        return pair_keys // num_card_ids, pair_keys % num_card_ids
 
     def _precompute_inclusion_rates(self, threshold):
         """Pre-compute all base inclusion rates"""
         print("Pre-computing base inclusion rates...")
 
         cards_above_threshold = self._get_cards_above_threshold(threshold)
-        cards_list = list(cards_above_threshold)
-        placeholders = ','.join('?' * len(cards_list))
         
-        result = self.cursor.execute(f"""
-            SELECT card_id, COUNT(DISTINCT deck_id) as count
-            FROM deck_cards 
-            WHERE card_id IN ({placeholders})
-            GROUP BY card_id
-        """, cards_list).fetchall()
+        # Dense tensor indexed by card id so rates can be gathered for many cards at once
+        inclusion_rates = np.zeros(len(self.card_deck_counts), dtype=np.float32)
+        if self.num_decks > 0:
+            inclusion_rates[cards_above_threshold] = self.card_deck_counts[cards_above_threshold] / self.num_decks
+        self.inclusion_rates_cache = torch.from_numpy(inclusion_rates)
+        self.inclusion_rates_threshold = threshold
         
-        for card_id, count in result:
-            self.inclusion_rates_cache[card_id] = count / self.num_decks if self.num_decks > 0 else 0.0
-        
-        print(f"Cached {len(self.inclusion_rates_cache)} inclusion rates")
+        print(f"Cached {len(cards_above_threshold)} inclusion rates")
+
+    def _conditional_rates_cache_path(self, threshold):
+        """On-disk cache location for conditional rates, keyed on the database contents and threshold"""
+        self._load_deck_cards()
+        max_deck_id = self.cursor.execute("SELECT COALESCE(MAX(id), 0) FROM decks").fetchone()[0]
+        key = hashlib.sha1(
+            f"v{CONDITIONAL_RATES_CACHE_VERSION}|{os.path.abspath(self.db_path)}|{max_deck_id}|{self.num_decks}|{len(self.deck_card_ids)}|{threshold}".encode()
+        )
+        # Hash the rows too, a re-scrape can reproduce the same counts with different contents
+        key.update(self.deck_card_commanders.tobytes())
+        key.update(self.deck_card_ids.tobytes())
+        return self.cache_dir / f"cond_rates_{key.hexdigest()[:16]}"
+
+    def _load_conditional_rates(self, cache_path):
+        """Memory-map cached conditional rate arrays"""
+        self.conditional_rates_cache = {
+            name: np.load(cache_path / f"{name}.npy", mmap_mode='r')
+            for name in ('key', 'rate')
+        }
 
     def _precompute_all_conditional_rates(self, threshold):
-        """Pre-compute all conditional inclusion rates in bulk"""
+        """Pre-compute all conditional inclusion rates in bulk, or load them from the on-disk cache"""
         print("Pre-computing all conditional inclusion rates...")
         start_time = time.time()
         
+        # Rates only change when new decks are scraped, so reuse them across runs
+        cache_path = self._conditional_rates_cache_path(threshold)
+        if cache_path.exists():
+            self._load_conditional_rates(cache_path)
+            print(f"Loaded {len(self.conditional_rates_cache['rate']):,} cached conditional rates from {cache_path}")
+            return
+        
+        # Check before any SQL work, the packed keys can't hold larger ids
+        num_card_ids = len(self.card_deck_counts)
+        if num_card_ids > 1 << CARD_ID_BITS:
+            raise ValueError(f"Card ids must be below {1 << CARD_ID_BITS} to pack conditional rate keys")
+        
         # Get cards above threshold
         cards_above_threshold = self._get_cards_above_threshold(threshold)
-        cards_list = list(cards_above_threshold)
+        cards_list = cards_above_threshold.tolist()
         
-        # Single massive query to get all conditional rates at once
-        placeholders = ','.join('?' * len(cards_list))
+        # Temp table of cards above threshold for both queries to join against
+        self.cursor.execute("DROP TABLE IF EXISTS temp.threshold_cards")
+        self.cursor.execute("CREATE TEMP TABLE threshold_cards(card_id INTEGER PRIMARY KEY)")
+        self.cursor.executemany("INSERT INTO threshold_cards (card_id) VALUES (?)", [(card_id,) for card_id in cards_list])
         
-        print("Executing bulk conditional rates query...")
-        result = self.cursor.execute(f"""
+        # Denominators: number of decks per commander containing the condition card
+        print("Counting commander-card deck totals...")
+        deck_counts = np.fromiter(chain.from_iterable(self.cursor.execute("""
+            SELECT d.commander_id, dc.card_id, COUNT(*)
+            FROM decks d
+            JOIN deck_cards dc ON dc.deck_id = d.id
+            JOIN threshold_cards t ON t.card_id = dc.card_id
+            GROUP BY d.commander_id, dc.card_id
+            ORDER BY d.commander_id, dc.card_id
+        """)), dtype=np.int32).reshape(-1, 3)
+        
+        # Numerators: number of decks per commander containing both the condition and target card
+        print("Executing bulk co-occurrence query...")
+        co_counts = np.fromiter(chain.from_iterable(self.cursor.execute("""
             SELECT 
                 d.commander_id,
                 dc_condition.card_id as condition_card_id,
                 dc_target.card_id as target_card_id,
-                COUNT(DISTINCT d.id) as denominator,
-                COUNT(DISTINCT CASE WHEN dc_target.card_id IS NOT NULL THEN d.id END) as numerator
+                COUNT(*) as count
             FROM decks d
             JOIN deck_cards dc_condition ON dc_condition.deck_id = d.id
-            LEFT JOIN deck_cards dc_target ON dc_target.deck_id = d.id
-            WHERE dc_condition.card_id IN ({placeholders})
-            AND (dc_target.card_id IN ({placeholders}) OR dc_target.card_id IS NULL)
+            JOIN threshold_cards t_condition ON t_condition.card_id = dc_condition.card_id
+            JOIN deck_cards dc_target ON dc_target.deck_id = d.id
+            JOIN threshold_cards t_target ON t_target.card_id = dc_target.card_id
+            WHERE dc_condition.card_id <> dc_target.card_id
             GROUP BY d.commander_id, dc_condition.card_id, dc_target.card_id
-            HAVING COUNT(DISTINCT d.id) > 0
-        """, cards_list + cards_list).fetchall()
+            ORDER BY d.commander_id, dc_condition.card_id, dc_target.card_id
+        """)), dtype=np.int32).reshape(-1, 4)
         
-        # Store in nested dict: {commander_id: {condition_card: {target_card: rate}}}
+        # Both results are sorted by (commander, card), so find each row's denominator by binary search
+        deck_count_keys = deck_counts[:, 0].astype(np.int64) * num_card_ids + deck_counts[:, 1]
+        condition_keys = co_counts[:, 0].astype(np.int64) * num_card_ids + co_counts[:, 1]
+        denominators = deck_counts[np.searchsorted(deck_count_keys, condition_keys), 2]
         
-        for commander_id, condition_card, target_card, denominator, numerator in result:
-            if target_card is None:  # Skip NULL targets
-                continue
+        # Save keys and rates to a temp directory and rename it, so interrupted runs leave no partial cache
+        tmp_path = cache_path.with_name(cache_path.name + ".tmp")
+        tmp_path.mkdir(parents=True, exist_ok=True)
+        np.save(tmp_path / "key.npy", _conditional_rate_keys(co_counts[:, 0], co_counts[:, 1], co_counts[:, 2]))
+        np.save(tmp_path / "rate.npy", (co_counts[:, 3] / denominators).astype(np.float32))
+        tmp_path.rename(cache_path)
+        self._load_conditional_rates(cache_path)
 
-            if commander_id not in self.conditional_rates_cache:
-                self.conditional_rates_cache[commander_id] = {}
-            if condition_card not in self.conditional_rates_cache[commander_id]:
-                self.conditional_rates_cache[commander_id][condition_card] = {}
+        elapsed = time.time() - start_time
+        print(f"Pre-computed {len(co_counts):,} conditional rates in {elapsed:.2f}s")
 
-            rate = numerator / denominator if denominator > 0 else 0.0
-            self.conditional_rates_cache[commander_id][condition_card][target_card] = rate
+    def _get_conditional_inclusion_rates_cached(self, card_ids, condition_card_ids, condition_commander_ids):
+        """Vectorized conditional inclusion rate lookup for arrays of ids, 0.0 for missing combinations"""
+        cache_keys = self.conditional_rates_cache['key']
+        keys = _conditional_rate_keys(condition_commander_ids, condition_card_ids, card_ids)
+        if len(cache_keys) == 0:
+            return np.zeros(len(keys), dtype=np.float32)
+        idx = np.minimum(np.searchsorted(cache_keys, keys), len(cache_keys) - 1)
+        return np.where(cache_keys[idx] == keys, self.conditional_rates_cache['rate'][idx], np.float32(0.0))
 
-        elapsed = time.time() - start_time
-        print(f"Pre-computed {len(result):,} conditional rates in {elapsed:.2f}s")
-
-    def _get_conditional_inclusion_rate_cached(self, card_id, condition_card_id, condition_commander_id):
-        """Get cached conditional inclusion rate - O(1) lookup!"""
-        try:
-            return self.conditional_rates_cache[condition_commander_id][condition_card_id][card_id]
-        except KeyError:
-            return 0.0  # Default for missing combinations
-
-    def _get_score(self, card_id, condition_card_id, condition_commander_id):
-        """Optimized score calculation using cached rates"""
-        inclusion_rate = self.inclusion_rates_cache.get(card_id, 0.0)
-        conditional_rate = self._get_conditional_inclusion_rate_cached(
-            card_id, condition_card_id, condition_commander_id
-        )
-        return self.score_fn(conditional_rate, inclusion_rate)
+    def _get_scores(self, card_ids, condition_card_ids, condition_commander_ids):
+        """Vectorized score calculation using cached rates, takes 1D tensors of ids"""
+        inclusion_rates = self.inclusion_rates_cache[card_ids]
+        conditional_rates = torch.from_numpy(self._get_conditional_inclusion_rates_cached(
+            card_ids.numpy(), condition_card_ids.numpy(), condition_commander_ids.numpy()
+        ))
+        return self.score_fn(conditional_rates, inclusion_rates)
 
     def pmi(self, conditional_rate, inclusion_rate, min_conditional_rate = .0001):
-        conditional_rate = max(conditional_rate, min_conditional_rate)
-        return log2(conditional_rate / inclusion_rate)
-    
-    # generate a training example (commander_id, condition_card_id, target_card_id) -> score
-    def _generate_training_example(self, commander_id, condition_card_id, target_card_id):
-        score = self._get_score(target_card_id, condition_card_id, commander_id)
-        return torch.tensor([commander_id, condition_card_id, target_card_id], dtype=torch.long), torch.tensor([score], dtype=torch.float)
+        conditional_rate = torch.clamp(conditional_rate, min=min_conditional_rate)
+        return torch.log2(conditional_rate / inclusion_rate)
+
+    def _sample_commander_examples(self, commander_id, cards, examples_per_pair, seed):
+        """Sample and score one commander's examples, scores as raw bf16 bits"""
+        rng = np.random.default_rng(seed)
+        # The examples_per_pair smallest random keys in each row pick that condition card's targets
+        keys = rng.random((len(cards), len(cards)), dtype=np.float32)
+        order = np.argpartition(keys, examples_per_pair - 1, axis=1)
+        del keys
+        target_card_ids = cards[order[:, :examples_per_pair]]
+        del order  # free the n x n buffers before building examples
+        condition_card_ids = np.broadcast_to(cards[:, None], target_card_ids.shape)
+        keep = target_card_ids != condition_card_ids
+        
+        examples = np.empty((np.count_nonzero(keep), 3), dtype=np.int32)
+        examples[:, 0] = commander_id
+        examples[:, 1] = condition_card_ids[keep]
+        examples[:, 2] = target_card_ids[keep]
+        
+        block = torch.from_numpy(examples)
+        scores = self._get_scores(block[:, 2], block[:, 1], block[:, 0]).to(torch.bfloat16)
+        return examples, scores.view(torch.int16).numpy()
 
     # create the full training set
-    def create_training_set(self, threshold=500):
+    def create_training_set(self, threshold=500, num_workers=None, output_dir='data/processed/training_set'):
         start_time = time.time()
         
         print("Caching cards above threshold...")
         cards_above_threshold = self._get_cards_above_threshold(threshold)
         print(f"Found {len(cards_above_threshold)} cards above threshold {threshold}")
         
-        print("Getting all commander-card mappings...")
-        commander_cards = self._get_all_commander_cards_above_threshold(threshold)
+        print("Getting commander-card pairs...")
+        pair_commander_ids, pair_card_ids = self._get_commander_card_pairs_above_threshold(threshold)
+        print(f"Found {len(pair_card_ids)} commander-card pairs")
+        
+        # Group by commander as views into the sorted pair arrays
+        commander_ids, commander_starts = np.unique(pair_commander_ids, return_index=True)
+        commander_cards = dict(zip(commander_ids.tolist(), np.split(pair_card_ids, commander_starts[1:])))
         print(f"Found {len(commander_cards)} commanders")
         
-        print("Getting commander-card pairs...")
-        pairs = self._get_commander_card_pairs_above_threshold(threshold)
-        print(f"Found {len(pairs)} commander-card pairs")
+        # Inclusion rates must cover every card above this threshold
+        if threshold != self.inclusion_rates_threshold:
+            self._precompute_inclusion_rates(threshold)
+        self._precompute_all_conditional_rates(threshold)
         
         # limit examples per pair to the minimum number of cards available for any commander
         # so dataset is balanced
-        examples_per_pair = torch.min(torch.LongTensor([len(cards) for cards in commander_cards.values()])).item()
+        examples_per_pair = min((len(cards) for cards in commander_cards.values()), default=0)
         
-        # Pre-allocate tensors
-        estimated_examples = len(pairs) * examples_per_pair
-        data = torch.zeros((estimated_examples, 3), dtype=torch.long)
-        scores = torch.zeros(estimated_examples, dtype=torch.float)
+        # Fill pre-allocated memory-mapped files in place, scores as raw bf16 bits since NumPy has no bfloat16
+        estimated_examples = len(pair_card_ids) * examples_per_pair
+        output_dir = Path(output_dir)
+        output_dir.mkdir(parents=True, exist_ok=True)
+        data_path, scores_path = output_dir / "data.dat", output_dir / "scores.dat"
+        if estimated_examples > 0:
+            data = np.memmap(data_path, dtype=np.int32, mode='w+', shape=(estimated_examples, 3))
+            scores = np.memmap(scores_path, dtype=np.int16, mode='w+', shape=(estimated_examples,))
+        else:
+            # np.memmap can't map an empty file, and there is nothing to sample
+            data_path.write_bytes(b'')
+            scores_path.write_bytes(b'')
         
         example_idx = 0
-        torch.random.manual_seed(42)
-        
-        for i, (commander_id, condition_card_id) in enumerate(pairs):
-            # Get cards from cache instead of SQL query!
-            cards_in_commander = commander_cards.get(commander_id, [])
-            cards_in_commander = torch.tensor(cards_in_commander)
-            
-            # Shuffle and sample
-            shuffled_indices = torch.randperm(len(cards_in_commander))
-            cards_in_commander = cards_in_commander[shuffled_indices[:examples_per_pair]]
-            
-            for target_card_id in cards_in_commander:
-                if target_card_id.item() == condition_card_id:
-                    continue
-                    
-                example, score = self._generate_training_example(
-                    commander_id, condition_card_id, target_card_id.item()
-                )
-                data[example_idx] = example
-                scores[example_idx] = score
-                example_idx += 1
-            
-            if i % 1000 == 0:
+        pairs_done = 0
+        # Independent random stream per commander, so results don't depend on thread scheduling
+        seeds = np.random.SeedSequence(42).spawn(len(commander_cards))
+        
+        # Each task holds n x n sampling buffers, so keep the default thread count small
+        num_workers = num_workers or min(4, os.cpu_count() or 1)
+        # Sliding window of submitted commanders so finished blocks can't pile up in RAM
+        max_in_flight = 2 * num_workers
+        pending = deque()
+        commander_tasks = iter(zip(commander_cards.items(), seeds))
+        with ThreadPoolExecutor(max_workers=num_workers) as executor:
+            while True:
+                for (commander_id, cards), seed in commander_tasks:
+                    pending.append((cards, executor.submit(
+                        self._sample_commander_examples, commander_id, cards, examples_per_pair, seed
+                    )))
+                    if len(pending) >= max_in_flight:
+                        break
+                if not pending:
+                    break
+                
+                # Consume in commander order and write each block into its slice of the output
+                cards, future = pending.popleft()
+                examples, block_scores = future.result()
+                end_idx = example_idx + len(examples)
+                data[example_idx:end_idx] = examples
+                scores[example_idx:end_idx] = block_scores
+                example_idx = end_idx
+                pairs_done += len(cards)
+                
                 elapsed = time.time() - start_time
                 rate = example_idx / elapsed if elapsed > 0 else 0
-                print(f"Progress: {i:,}/{len(pairs):,} pairs, {example_idx:,} examples, {rate:.0f} examples/sec")
+                print(f"Progress: {pairs_done:,}/{len(pair_card_ids):,} pairs, {example_idx:,} examples, {rate:.0f} examples/sec")
         
-        # Trim and save
-        data = data[:example_idx]
-        scores = scores[:example_idx]
+        # Trim the files to the examples actually written and record the size next to them
+        if estimated_examples > 0:
+            data.flush()
+            scores.flush()
+            del data, scores
+        os.truncate(data_path, example_idx * 3 * np.dtype(np.int32).itemsize)
+        os.truncate(scores_path, example_idx * np.dtype(np.int16).itemsize)
+        with open(output_dir / "meta.json", 'w') as f:
+            json.dump({'num_examples': example_idx, 'data_dtype': 'int32', 'scores_dtype': 'bfloat16'}, f)
         
-        torch.save({'data': data, 'scores': scores}, "data/processed/training_set.pt")
-        print(f"Created {len(data):,} examples in {time.time() - start_time:.2f}s")
+        print(f"Created {example_idx:,} examples in {time.time() - start_time:.2f}s")
         
-        return data, scores
+        return load_training_set(output_dir)
@@ -4,8 +4,12 @@ import torch
 class CardPointwiseMutualPredictor(nn.Module):
     def __init__(self, num_cards, num_commanders, embed_dim, hidden_size=256):
         super(CardPointwiseMutualPredictor, self).__init__()
-        self.card_embedding = nn.Embedding(num_embeddings=num_cards, embedding_dim=embed_dim)
-        self.commander_embedding = nn.Embedding(num_embeddings=num_commanders, embedding_dim=embed_dim)
+        # num_cards and num_commanders are table sizes, so they must be the largest id + 1
+        self.num_commanders = num_commanders
+        # Commanders and cards share one table (commanders first), so each (commander, condition card, target card)
+        # row is embedded with a single lookup after shifting the card ids past the commanders
+        self.embedding = nn.Embedding(num_embeddings=num_commanders + num_cards, embedding_dim=embed_dim)
+        self.register_buffer('index_offsets', torch.tensor([0, num_commanders, num_commanders]), persistent=False)
         self.encoder = nn.Sequential(
             nn.Linear(3 * embed_dim, hidden_size),
             nn.ReLU(),
@@ -16,16 +20,18 @@ class CardPointwiseMutualPredictor(nn.Module):
         )
     
     def forward(self, x):
-        commander_embed = self.commander_embedding(x[:, 0])
-        condition_card_embed = self.card_embedding(x[:, 1])
-        target_card_embed = self.card_embedding(x[:, 2])
-        
-        combined = torch.cat([commander_embed, condition_card_embed, target_card_embed], dim=-1)
-        score = self.encoder(combined)
+        # Out of range ids would silently read a neighbouring section of the joint table
+        if ((x[:, 0] >= self.num_commanders) | (x[:, 1:] < 0).any(1)).any():
+            raise IndexError(f"Commander ids must be below {self.num_commanders} and card ids non-negative")
+        # x holds int32 or int64 ids. (B, 3, D) lookup flattened to (B, 3 * D) is a view, no concat needed
+        combined = self.embedding(x + self.index_offsets).flatten(1)
+        # Run the MLP in bf16 on GPU
+        with torch.autocast(device_type=x.device.type, dtype=torch.bfloat16, enabled=x.device.type == 'cuda'):
+            score = self.encoder(combined)
         return score
     
     def card_embeddings(self):
-        return self.card_embedding.weight.data.cpu()
+        return self.embedding.weight.data[self.num_commanders:].cpu()
     
     def commander_embeddings(self):
-        return self.commander_embedding.weight.data.cpu()
+        return self.embedding.weight.data[:self.num_commanders].cpu()